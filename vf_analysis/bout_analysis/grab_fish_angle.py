@@ -16,6 +16,11 @@ NOTE: frame rate is partially soft-coded.
 # %%
 # Import Modules and functions
 import sys
+import os
+import io
+from contextlib import redirect_stdout, ExitStack
+from concurrent.futures import ProcessPoolExecutor
+import numba
 import pandas as pd # pandas library
 import numpy as np # numpy
 from collections import defaultdict
@@ -860,10 +865,26 @@ def grab_fish_angle(analyzed, fish_length):
     print(f" {len(bout_res2)} bouts aligned")
     return output
 
-def run(filenames, folder):
+def init_worker(num_threads):
+    '''Each worker process analyzes one .dlm at a time, share the CPUs between workers so that numba doesn't start too many threads'''
+    numba.set_num_threads(num_threads)
+
+def analyze_file(i, file, folder):
+    '''
+    Read and analyze one .dlm file. Unit of work for the process pool in run()
+    Printed progress is captured and returned with the results, so that messages from different files don't mix
     '''
-    Loop through all .dlm, run analyze_dlm() and grab_fish_angle() functions
-    Concatinate results from different .dlm files
+    with redirect_stdout(io.StringIO()) as log:
+        raw = read_dlm(i, file)
+        analyzed, fish_length = analyze_dlm(raw, i, file, folder)
+        res = grab_fish_angle(analyzed, fish_length)
+    return res, log.getvalue()
+
+def run(filenames, folder, max_workers=None):
+    '''
+    Analyze all .dlm files in parallel processes, run analyze_dlm() and grab_fish_angle() functions
+    Concatinate results from different .dlm files, in the order of filenames
+    max_workers: number of processes, default is the number of CPUs. With 1, files are analyzed in this process without a pool
     '''
     # initialize output vars
     grabbed_all = pd.DataFrame()
@@ -882,26 +903,39 @@ def run(filenames, folder):
     heading_matched = pd.DataFrame()
     epoch_pitch_heading_RMS = pd.DataFrame()
  
-    for i, file in enumerate(filenames):
-        raw = read_dlm(i, file)
-        analyzed, fish_length = analyze_dlm(raw, i, file, folder)
-        res = grab_fish_angle(analyzed, fish_length)
-        # transfer values to final var
-        grabbed_all = pd.concat([grabbed_all, res['grabbed_all']], ignore_index=True)
-        baseline_angVel = pd.concat([baseline_angVel, res['baseline_angVel']], ignore_index=True)
-        bout_attributes = pd.concat([bout_attributes, res['bout_attributes']], ignore_index=True)
-        prop_bout_aligned = pd.concat([prop_bout_aligned, res['prop_bout_aligned']], ignore_index=True)
-        prop_bout2 = pd.concat([prop_bout2, res['prop_bout2']], ignore_index=True)
-        prop_bout_aligned_long = pd.concat([prop_bout_aligned_long, res['prop_bout_aligned_long']], ignore_index=True)
-        prop_bout_aligned_long2 = pd.concat([prop_bout_aligned_long2, res['prop_bout_aligned_long2']], ignore_index=True)
-        IEI_attributes = pd.concat([IEI_attributes, res['IEI_attributes']], ignore_index=True)
-        prop_bout_IEI_aligned = pd.concat([prop_bout_IEI_aligned, res['prop_bout_IEI_aligned']], ignore_index=True)
-        prop_bout_IEI2 = pd.concat([prop_bout_IEI2, res['prop_bout_IEI2']], ignore_index=True)
-        prop_bout_IEI_timed = pd.concat([prop_bout_IEI_timed, res['prop_bout_IEI_timed']], ignore_index=True)
-        wolpert_IEI = pd.concat([wolpert_IEI, res['wolpert_IEI']], ignore_index=True)
-        epoch_attributes = pd.concat([epoch_attributes, res['epoch_attributes']], ignore_index=True)
-        heading_matched = pd.concat([heading_matched, res['heading_matched']], ignore_index=True)
-        epoch_pitch_heading_RMS = pd.concat([epoch_pitch_heading_RMS, res['epoch_pitch_heading_RMS']], ignore_index=True)
+    cpu_count = os.cpu_count() or 1
+    if max_workers is None:
+        max_workers = cpu_count
+    max_workers = max(1, min(max_workers, len(filenames)))
+    args = (range(len(filenames)), filenames, [folder] * len(filenames))
+    with ExitStack() as stack:
+        if max_workers == 1:
+            # no need for a pool, numba kernels use all threads of this process
+            all_res = map(analyze_file, *args)
+        else:
+            # CPUs not used by worker processes are left to the numba threads in each of them
+            executor = stack.enter_context(ProcessPoolExecutor(
+                max_workers=max_workers, initializer=init_worker, initargs=(max(1, cpu_count // max_workers),)
+            ))
+            all_res = executor.map(analyze_file, *args)
+        for res, log in all_res:
+            print(log, end='')
+            # transfer values to final var
+            grabbed_all = pd.concat([grabbed_all, res['grabbed_all']], ignore_index=True)
+            baseline_angVel = pd.concat([baseline_angVel, res['baseline_angVel']], ignore_index=True)
+            bout_attributes = pd.concat([bout_attributes, res['bout_attributes']], ignore_index=True)
+            prop_bout_aligned = pd.concat([prop_bout_aligned, res['prop_bout_aligned']], ignore_index=True)
+            prop_bout2 = pd.concat([prop_bout2, res['prop_bout2']], ignore_index=True)
+            prop_bout_aligned_long = pd.concat([prop_bout_aligned_long, res['prop_bout_aligned_long']], ignore_index=True)
+            prop_bout_aligned_long2 = pd.concat([prop_bout_aligned_long2, res['prop_bout_aligned_long2']], ignore_index=True)
+            IEI_attributes = pd.concat([IEI_attributes, res['IEI_attributes']], ignore_index=True)
+            prop_bout_IEI_aligned = pd.concat([prop_bout_IEI_aligned, res['prop_bout_IEI_aligned']], ignore_index=True)
+            prop_bout_IEI2 = pd.concat([prop_bout_IEI2, res['prop_bout_IEI2']], ignore_index=True)
+            prop_bout_IEI_timed = pd.concat([prop_bout_IEI_timed, res['prop_bout_IEI_timed']], ignore_index=True)
+            wolpert_IEI = pd.concat([wolpert_IEI, res['wolpert_IEI']], ignore_index=True)
+            epoch_attributes = pd.concat([epoch_attributes, res['epoch_attributes']], ignore_index=True)
+            heading_matched = pd.concat([heading_matched, res['heading_matched']], ignore_index=True)
+            epoch_pitch_heading_RMS = pd.concat([epoch_pitch_heading_RMS, res['epoch_pitch_heading_RMS']], ignore_index=True)
     
     # %%    
     output_dir = f"{folder}"
@@ -16,11 +16,13 @@ Analyze Free Vertical (YZ 2020.05.28)
     1. Results of filtered epochs may be slightly different from Matlab results, due to the angVel smooth function
         Matlab smooth handles top/end values differently. Here, top values without enought window (smooth span) are returned as NA
     2. Due to the float64 data type, calculations are more accurate in Python version.
+        Derived values (coordinates, velocities, fish length...) are stored as float32 after calculation and filtering.
 '''
 # %%
 # Import Modules and functions
 import pandas as pd # pandas library
 import numpy as np # numpy
+from numba import njit, prange
 from datetime import datetime
 from datetime import timedelta
 
@@ -41,7 +43,7 @@ EPOCH_BUF = 2        # truncate the epochs from both ends. In Matlab code, 3 was
 
 # Other parameters
 SCALE = 60           #(pix/mm) ofr BlackFly verticle fish rigs 1-6
-SM_WINDOW_FOR_FILTER = 9     # smoothing
+SM_WINDOW_FOR_FILTER = 9     # smoothing. must be odd. 9 and 3 (the defaults) use the specialized smooth_w9_at() and smooth_w3_at(), other sizes use smooth_ml_at()
 SM_WINDOW_FOR_ANGVEL = 3
 
 # %%
@@ -50,172 +52,265 @@ def grp_by_epoch(df):
     # Group df by 'epochNum'. If cols is empty take all columns
     return df.groupby('epochNum', sort=False)
 
-def smooth_series_ML(a,WSZ):
+def epoch_offsets(epoch_num):
+    # Row offsets of each epoch from where epochNum changes, epochs must be contiguous. Rows of epoch i are offsets[i]:offsets[i+1]
+    # no hashing like groupby, use np.diff(offsets) for epoch sizes
+    if len(epoch_num) == 0:
+        return np.zeros(1, dtype=np.int64)
+    boundaries = np.flatnonzero(np.diff(epoch_num)) + 1
+    return np.concatenate(([0], boundaries, [len(epoch_num)]))
+
+@njit(cache=True)
+def smooth_ml_at(values, s, t, WSZ, i):
     '''
-    Modified from Divakar's answer https://stackoverflow.com/questions/40443020/matlabs-smooth-implementation-n-point-moving-average-in-numpy-python
-    a: NumPy 1-D array containing the data to be smoothed
+    Matlab smooth() value at row i of one epoch, based on smooth_series_ML() from Divakar's answer
+    https://stackoverflow.com/questions/40443020/matlabs-smooth-implementation-n-point-moving-average-in-numpy-python
+    values: NumPy 1-D array containing the data to be smoothed, the epoch is values[s:t]
     WSZ: smoothing window size needs, which must be odd number,
     as in the original MATLAB implementation
     '''
-    out0 = np.convolve(a,np.ones(WSZ,dtype=int),'valid')/WSZ    
-    r = np.arange(1,WSZ-1,2)
-    start = np.cumsum(a[:WSZ-1])[::2]/r
-    stop = (np.cumsum(a[:-WSZ:-1])[::2]/r)[::-1]
-    res = np.concatenate((  start , out0, stop  ))
-    return pd.Series(data=res, index=a.index)
+    # window shrinks to the available values at both ends (start/stop ramps in Matlab)
+    h = min((WSZ - 1) // 2, i - s, t - 1 - i)
+    acc = 0.0
+    for j in range(i - h, i + h + 1):
+        acc += values[j]
+    return acc / (2 * h + 1)
+
+@njit('float64(float64[:], int64, int64, int64)', cache=True)
+def smooth_w3_at(values, s, t, i):
+    # smooth_ml_at() with WSZ = 3 (SM_WINDOW_FOR_ANGVEL). Window sum is unrolled, only the epoch ends go through the ramps
+    if s < i < t - 1:
+        return (values[i - 1] + values[i] + values[i + 1]) / 3
+    return smooth_ml_at(values, s, t, 3, i)
+
+@njit('float64(float64[:], int64, int64, int64)', cache=True)
+def smooth_w9_at(values, s, t, i):
+    # smooth_ml_at() with WSZ = 9 (SM_WINDOW_FOR_FILTER). Window sum is unrolled, only the epoch ends go through the ramps
+    if s + 4 <= i < t - 4:
+        return (values[i - 4] + values[i - 3] + values[i - 2] + values[i - 1] + values[i]
+                + values[i + 1] + values[i + 2] + values[i + 3] + values[i + 4]) / 9
+    return smooth_ml_at(values, s, t, 9, i)
+
+@njit(cache=True)
+def nan_max(m, v):
+    # running max that ignores NA values, same as np.nanmax(). Start with m = NA, stays NA if all values are NA
+    if v == v and (m != m or v > m):
+        return v
+    return m
+
+@njit(cache=True)
+def nan_abs_max(m, v):
+    # running max of absolute values that ignores NA values, same as np.nanmax(np.abs()) without the abs array
+    return nan_max(m, abs(v))
+
+@njit(cache=True)
+def median3(a, b, c):
+    # median of 3 values, NA if any of them is NA, same as .rolling(3).median()
+    # sort the 3 values with swaps and take the middle one. exact, unlike adding and subtracting values
+    if a != a or b != b or c != c:
+        return np.nan
+    if a > b:
+        a, b = b, a
+    if b > c:
+        b, c = c, b
+    if a > b:
+        a, b = b, a
+    return b
 
 # define filter function
 def raw_filter(df):
     # Trim epoch by EPOCH_BUF and filter by duration & fish number
-    # First, group by epoch number
-    grouped = grp_by_epoch(df)
+    # rows are not selected here. Returns truncated row range (starts, ends) and the filter result (keep) of each epoch
+    # so that all filters can be combined and rows selected only once, see analyze_dlm()
+    offsets = epoch_offsets(df['epochNum'].values)
+    sizes = np.diff(offsets)
     # Truncate epoch, see EPOCH_BUF for details
-    # use .cumcount() to return indices within group
-    del_buf = df[(grouped.cumcount(ascending=False) >= EPOCH_BUF) 
-        & (grouped.cumcount() >= EPOCH_BUF)]
-    # Flter by epoch duration & number of fish in the frame
-    filtered = grp_by_epoch(del_buf).filter(
-        lambda g: len(g) >= MIN_DUR and 
-        np.nanmax(g['fishNum'].values) < MAX_FISH
+    starts = offsets[:-1] + EPOCH_BUF
+    ends = offsets[1:] - EPOCH_BUF
+    if len(df) == 0:
+        print(".", end = '')
+        return starts, ends, np.zeros(0, dtype=np.bool_)
+    # get ascending and descending indices within epoch from offsets
+    asc = np.arange(len(df)) - np.repeat(offsets[:-1], sizes)
+    desc = np.repeat(sizes, sizes) - 1 - asc
+    in_buf = (asc >= EPOCH_BUF) & (desc >= EPOCH_BUF)
+    # Flter by epoch duration & number of fish in the frame, after truncation
+    # get one value per epoch with .reduceat(). truncated rows are set to NA, which np.fmax ignores
+    fish_num = np.where(in_buf, df['fishNum'].values, np.nan)
+    keep = (
+        (np.maximum(ends - starts, 0) >= MIN_DUR)
+        & (np.fmax.reduceat(fish_num, offsets[:-1]) < MAX_FISH)
     )
     print(".", end = '')
-    return filtered
-
-def dur_y_x_filter(df):
-    # drop epochs with inexplicably large gaps between frame
-    f1 = grp_by_epoch(df).filter(
-        lambda g: np.nanmax(g['deltaT'].values) <= MAX_DELTA_T
-    # turned off in Kyla's version
-    #     # exclude fish bouts vertically down (sinking faster than 5mm/sec). 
-    #     # Flip the sign so positive deltaY corresponds to upward motion
-    #     and -(np.nanmax(np.diff(g['y'].values, prepend=g['y'].values[0]))) > MIN_VERTICLE_VEL * FRAME_INTERVAL * SCALE
-    )
-    # only keep swims in which fish is pointed in the direction it moves. Within an epoch, if headx is greater than x (pointing right), x.tail should also be greater than x.head, and vice versa.
-    f2 = grp_by_epoch(f1).filter(
-        lambda g: ((g['headx'].mean() - g['x'].mean()) * g.tail(1)['x'].values)[0] >= 0
-    )
-    print(".", end='')
-    return f2
+    return starts, ends, keep
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def analyze_epochs(absx, absy, absHeadx, absHeady, ang, time, starts, ends,
+                   x, y, headx, heady, centeredAng, deltaT, xvel, yvel, dist, displ,
+                   angVel, angVelSmoothed, angAccel, keep, row_keep):
+    '''
+    Calculate and filter all epochs in parallel, one epoch per loop
+    Rows of epoch e are starts[e]:ends[e] of the raw arrays, see raw_filter()
+    Output arrays (x ... angAccel) have the length of the raw arrays and are only written for rows of epochs that are analyzed.
+    Values that can't be calculated at the beginning of each epoch are set to NA
+    keep: bool array, one per epoch, result of raw_filter(). Epochs already dropped are skipped, the others are set to True if they pass all filters
+    row_keep: bool array, one per row, initialized as False. Set to True for rows of epochs kept
+    Filters are applied to each epoch as a whole, so all of them can be checked in the same loop
+    '''
+    for e in prange(len(starts)):
+        if not keep[e]:
+            continue
+        s = starts[e]
+        t = ends[e]
+        # Calculate coordinates centered to the epoch start, and time difference
+        max_delta_t = np.nan
+        sum_x = 0.0
+        sum_headx = 0.0
+        for i in range(s, t):
+            x[i] = absx[i] - absx[s]
+            y[i] = absy[i] - absy[s]
+            headx[i] = absHeadx[i] - absHeadx[s]
+            heady[i] = absHeady[i] - absHeady[s]
+            centeredAng[i] = ang[i] - ang[s]
+            sum_x += x[i]
+            sum_headx += headx[i]
+            if i > s:
+                deltaT[i] = time[i] - time[i - 1]
+                max_delta_t = nan_max(max_delta_t, deltaT[i])
+        deltaT[s] = np.nan
+        # drop epochs with inexplicably large gaps between frame
+        # only keep swims in which fish is pointed in the direction it moves. Within an epoch, if headx is greater than x (pointing right), x.tail should also be greater than x.head, and vice versa.
+        if not (max_delta_t <= MAX_DELTA_T) or not ((sum_headx - sum_x) / (t - s) * x[t - 1] >= 0):
+            keep[e] = False
+            continue
 
-def displ_dist_vel_filter(df):
-    # drop epochs with improbably large instantaneous displacement, which happens where #fish > 1 but appear as 1 fish
-    f1 = grp_by_epoch(df).filter(
-        lambda g: np.nanmax(np.absolute(g['displ'].values)) <= MAX_INST_DISPL
+        # Calculate displacement, distance traveled, angular velocity, angular acceleration
+        max_displ = np.nan
+        max_ang_accel = np.nan
+        xvel[s] = yvel[s] = dist[s] = displ[s] = angVel[s] = np.nan
+        angAccel[s] = angAccel[s + 1] = np.nan
+        for i in range(s + 1, t):
+            dx = x[i] - x[i - 1]
+            dy = y[i] - y[i - 1]
+            xvel[i] = dx / deltaT[i]
+            yvel[i] = dy / deltaT[i]
+            dist[i] = np.hypot(dx, dy)
+            # since beginning coordinates for each epoch has been set to 0, just use (x, y) values for displ
+            displ[i] = np.hypot(x[i], y[i]) - np.hypot(x[i - 1], y[i - 1])
+            angVel[i] = (ang[i] - ang[i - 1]) / deltaT[i]
+            max_displ = nan_abs_max(max_displ, displ[i])
+            if i > s + 1:
+                angAccel[i] = (angVel[i] - angVel[i - 1]) / deltaT[i]
+                max_ang_accel = nan_abs_max(max_ang_accel, angAccel[i])
+
+        # smooth second to last angVel values (exclude the first one which is NA)
+        max_dist_dev = np.nan
+        max_ang_vel = np.nan
+        angVelSmoothed[s] = np.nan
+        for i in range(s + 1, t):
+            # window sizes are global constants, numba resolves these conditions at compile time
+            angVelSmoothed[i] = (smooth_w3_at(angVel, s + 1, t, i) if SM_WINDOW_FOR_ANGVEL == 3
+                                 else smooth_ml_at(angVel, s + 1, t, SM_WINDOW_FOR_ANGVEL, i))
+            # the angVel filter smooths the epoch including the leading NA, so the start ramp and the first full window are NA and not checked
+            if i >= s + 1 + (SM_WINDOW_FOR_FILTER - 1) // 2:
+                max_ang_vel = nan_abs_max(max_ang_vel, smooth_w9_at(angVel, s + 1, t, i) if SM_WINDOW_FOR_FILTER == 9
+                                          else smooth_ml_at(angVel, s + 1, t, SM_WINDOW_FOR_FILTER, i))
+            # dist.rolling(3, center=True).median() is NA at both ends and next to the first NA dist
+            if s + 2 <= i < t - 1:
+                max_dist_dev = nan_abs_max(max_dist_dev, dist[i] - median3(dist[i - 1], dist[i], dist[i + 1]))
+
+        # drop epochs with improbably large instantaneous displacement, which happens where #fish > 1 but appear as 1 fish
         # exclude epochs with sudden & large instantaneous movement (distance). Found in ~1-2 epochs per .dlm after MAX_INST_DISPL filtration - YZ 2020.05.13
-        # turn off vor now
-        and np.nanmax(np.abs(
-            g['dist'].values - g['dist'].rolling(3, center=True).median().values
-        )) < MAX_DIST_TRAVEL   
-    )
-    # exclude epochs with improbably large angular velocity. use smoothed results
-    f2 = grp_by_epoch(f1).filter(
-        lambda g: np.nanmax(np.abs(
-            smooth_series_ML(g.loc[1:,'angVel'], SM_WINDOW_FOR_FILTER).values
-        )) <= MAX_ANG_VEL
-    )
-    # exclude epochs with improbably large angular accel. numpy calculation is faster
-    f3 = grp_by_epoch(f2).filter(
-        lambda g: np.nanmax(np.abs(g['angAccel'].values)) <= MAX_ANG_ACCEL
-    )
-    print(".", end="")
-    return f3
+        # exclude epochs with improbably large angular velocity. use smoothed results
+        # exclude epochs with improbably large angular accel
+        keep[e] = (max_displ <= MAX_INST_DISPL
+                   and max_dist_dev < MAX_DIST_TRAVEL
+                   and max_ang_vel <= MAX_ANG_VEL
+                   and max_ang_accel <= MAX_ANG_ACCEL)
+        if keep[e]:
+            row_keep[s:t] = True
 
 # %%
 # Main function
 def analyze_dlm(raw, file_i, file, folder):
     
-    # truncate epochs
-    raw_truncate = raw_filter(raw).reset_index().rename(columns={'index': 'oriIndex'})
+    # truncate epochs and filter by duration & fish number. rows are selected only once after all filters
+    starts, ends, keep = raw_filter(raw)
+    # keep columns as arrays from here on (struct of arrays), only build dataframes at the end
+    cols = {col: raw[col].values for col in ['time','ang','absx','absy','absHeadx','absHeady','epochNum','fishLen']}
+    cols['oriIndex'] = raw.index.values
     
     # %%
-    # Calculate time/date and Filter for delta t
-
-    # Initialize dataframe for analyzed epochs
-    ana = pd.DataFrame()
-    # Transfer original index, epochNum, and time info
-    ana = raw_truncate[['oriIndex','epochNum','ang','absy']].copy()
-    # Calculate time difference
-    # use .assign() for assigning new columns, avoid df[['newCol]] or df.loc[:,'newCol']
-    ana = ana.assign(
-        deltaT = grp_by_epoch(raw_truncate).time.diff()
-    )
-    # Get the start time from file name
-    datetime_frmt = '%y%m%d %H.%M.%S'
-    time_stamp = file[-19:-4]
-    start_time = datetime.strptime(time_stamp, datetime_frmt)
-    # Calculate absolute datetime for each timepoint. DataFrame calculation is faster than using .apply()
-    ana.insert(1,
-        'absTime', start_time + pd.to_timedelta(raw_truncate['time'].values, unit=('s'))
-    )
+    # Calculate and filter epochs
 
-    # Calculate coordinates
-    #   dataframe subduction is faster than cumulative difference. 
-    #   Use .values to convert into arrays to further speed up
-    centered_coordinates = pd.DataFrame((
-        raw_truncate[['absx','absy','absHeadx','absHeady','ang']].values
-        - grp_by_epoch(raw_truncate)[['absx','absy','absHeadx','absHeady','ang']].transform('first').values
-    ), columns = ['x','y','headx','heady','centeredAng'])
-
-    ana = ana.join(centered_coordinates)
-
-    # Apply filters
-    ana_f = dur_y_x_filter(ana)
-
-    # %%
-    # Calculate displacement, distance traveled, angular velocity, angular acceleration and filter epochs
-
-    ana_f_g = grp_by_epoch(ana_f)
-    ana_f = ana_f.assign(
-        # x and y velocity. using np.divide() has shorter runtime than df.div()
-        xvel = np.divide(ana_f_g['x'].diff().values, ana_f['deltaT'].values),
-        yvel = np.divide(ana_f_g['y'].diff().values, ana_f['deltaT'].values),
-        # use numpy function np.linalg.norm() for displacement and distance
-        dist = np.linalg.norm(ana_f_g[['x','y']].diff(), axis=1),
-        # since beginning coordinates for each epoch has been set to 0, just use (x, y) values for displ
-        displ = ana_f.groupby('epochNum', as_index=False, sort=False).apply(
-            lambda g: pd.Series((np.linalg.norm(g[['x','y']], axis=1)),index = g.index).diff()
-        ).reset_index(level=0, drop=True),
-        # array calculation is more time effieient
-        angVel = np.divide(ana_f_g['ang'].diff().values, ana_f['deltaT'].values)
+    # Output arrays are filled by analyze_epochs() for rows of epochs analyzed, the rest are dropped
+    derived = {col: np.empty(len(raw)) for col in [
+        'deltaT','x','y','headx','heady','centeredAng',
+        'xvel','yvel','dist','displ','angVel','angVelSmoothed','angAccel'
+    ]}
+    row_keep = np.zeros(len(raw), dtype=np.bool_)
+    analyze_epochs(
+        cols['absx'], cols['absy'], cols['absHeadx'], cols['absHeady'], cols['ang'], cols['time'], starts, ends,
+        derived['x'], derived['y'], derived['headx'], derived['heady'], derived['centeredAng'],
+        derived['deltaT'], derived['xvel'], derived['yvel'], derived['dist'], derived['displ'],
+        derived['angVel'], derived['angVelSmoothed'], derived['angAccel'], keep, row_keep
     )
-    # now let's get smoothed angular vel and angular acceleration
-    ana_f = ana_f.assign(  
-        # loop through each epoch, get second to last angVel values (exclude the first one which is NA)
-        # calculate smooth, keep the index, assign to the new column
-        angVelSmoothed = pd.concat(
-            smooth_series_ML(g.tail(len(g)-1)['angVel'],SM_WINDOW_FOR_ANGVEL) for i, g in grp_by_epoch(ana_f)
-        ),
-        angAccel = np.divide(grp_by_epoch(ana_f)['angVel'].diff().values, ana_f['deltaT'].values),
-    )
-
-    # Apply filters, drop previous index
-    ana_ff = displ_dist_vel_filter(ana_f).reset_index(drop=True)
+    print(".", end='')
 
-    # Acquire fish length from raw data
-    ana_ff['fishLen'] = raw.loc[ana_ff['oriIndex'],'fishLen'].values
+    # Get the start time from file name, formatted as '%y%m%d %H.%M.%S'
+    # fields are fixed-width numbers, read them directly instead of using datetime.strptime()
+    start_time = datetime(
+        2000 + int(file[-19:-17]), int(file[-17:-15]), int(file[-15:-13]),
+        int(file[-12:-10]), int(file[-9:-7]), int(file[-6:-4])
+    )
+    # Calculate absolute datetime for each timepoint. Add time in ns to start time as int64, no need to build a TimedeltaIndex
+    start_ns = np.datetime64(start_time, 'ns').view('i8')
+    abs_time = (start_ns + np.rint(cols['time'][row_keep] * 1e9).astype('i8')).view('datetime64[ns]')
 
     # %%
     # SCALE distance and velocity and tansfer data we care
 
-    res = ana_ff.copy()
+    # Transfer original index, epochNum, and time info, keep rows of epochs that passed the filters
+    res_cols = {
+        'oriIndex': cols['oriIndex'][row_keep],
+        'absTime': abs_time,
+        'epochNum': cols['epochNum'][row_keep],
+        'ang': cols['ang'][row_keep],
+        'absy': cols['absy'][row_keep],
+    }
+    # filters were calculated in float64. Store derived values as float32, 7 significant digits are enough and it halves the memory
+    # keep time and angle (deltaT, centeredAng) in float64 to avoid roundoff through differences
+    res_cols.update(
+        (col, values[row_keep] if col in ('deltaT','centeredAng') else values[row_keep].astype(np.float32))
+        for col, values in derived.items()
+    )
+    # Acquire fish length from raw data
+    res_cols['fishLen'] = cols['fishLen'][row_keep].astype(np.float32)
     # SCALE coordinate and displ, flip signs of y, positive = upwards
-    res.loc[:,['y','heady','yvel']] = res[['y','heady','yvel']] * -1 / SCALE
-    res.loc[:,['x','headx','xvel','displ','dist','fishLen']] = res[['x','headx','xvel','displ','dist','fishLen']] / SCALE
+    # arrays in res_cols are new copies from boolean indexing, owned by this function. Scale them in place
+    for col in ['x','headx','xvel','dist','displ','fishLen']:
+        res_cols[col] /= SCALE
+    for col in ['y','heady','yvel']:
+        res_cols[col] /= -SCALE
+    delta_t = res_cols['deltaT']
     # calculate swim speed
-    res.loc[:,'swimSpeed'] = np.divide(res['dist'].values, res['deltaT'].values)
+    res_cols['swimSpeed'] = np.divide(res_cols['dist'], delta_t).astype(np.float32)
     # calculate swim velocity (displacement/)
-    res.loc[:,'velocity'] = np.divide(res['displ'].values, res['deltaT'].values)
-    # define fish length as 70th percentile of lengths captured.
-    fish_length = grp_by_epoch(res)['fishLen'].agg(
-        fishLenEst = lambda l: l.quantile(0.7)
-    ).reset_index()
+    res_cols['velocity'] = np.divide(res_cols['displ'], delta_t).astype(np.float32)
+    res = pd.DataFrame(res_cols)
+    # define fish length as 70th percentile of lengths captured. built-in groupby quantile avoids a lambda per epoch
+    if len(res) == 0:
+        # no epochs left, skip grouping
+        fish_length = pd.DataFrame({'epochNum': res['epochNum'].values, 'fishLenEst': np.empty(0)})
+    else:
+        fish_length = grp_by_epoch(res)['fishLen'].quantile(0.7).reset_index(name='fishLenEst')
 
     # %%
     # Save analyzed data!
 
     # res.to_pickle(f'{folder}/{file_i+1}_analyzed_epochs.pkl')
     # fish_length.to_pickle(f'{folder}/{file_i+1}_fish_length.pkl')
-    print(f" {len(grp_by_epoch(res).size())} epochs extracted", end=' ')
+    print(f" {np.count_nonzero(keep)} epochs extracted", end=' ')
 
     return res, fish_length
 